@@ -1,38 +1,70 @@
+import functools
+import logging
+import numpy as np
 import pandas as pd
 import requests
-import json
+import orjson
 import os
-import regex as re
-import urllib.parse
+import atexit
+import shelve
+import threading
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-with open("config.json", "r") as config_file:
-    configs = json.load(config_file)
-
-LAT_LON_API_KEY = configs["lat_lon_api_key"]
+CONFIG_FILE = "config.json"
+GEOCODING_API_URL = "https://api.api-ninjas.com/v1/geocoding"
 RESOURCE_NOT_FOUND_RESPONSE_CODE = 404
-WEATHER_API_BASE_URL = "https://archive-api.open-meteo.com/v1/archive?"
-WEATHER_API_URL_PARAMS = {
-    "latitude": "",
-    "longitude": "",
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+WEATHER_API_WORKERS = 16
+WEATHER_FILES_DIR = "weather_files"
+WEATHER_FILE_SUFFIX = "_weather.json"
+MIN_FILES_FOR_PROCESS_POOL = 32
+GEO_CACHE_FILE = "geo_cache.db"
+# the daily features used to calculate the annual weather data, in the order in which get_annual_data uses them
+DAILY_FEATURES = ("temperature_2m_min", "temperature_2m_max", "temperature_2m_mean", "precipitation_sum")
+MET_DATA_COLUMNS = ["Name", "min_temp", "max_temp", "mean_temp", "total_precipitation"]
+WEATHER_API_BASE_URL = "https://archive-api.open-meteo.com/v1/archive"
+# read-only, since it is shared between threads. The latitude and longitude are added per request.
+WEATHER_API_URL_PARAMS_TEMPLATE = MappingProxyType({
     "start_date": "2022-04-01",
     "end_date": "2023-04-01",
-    "daily": ["temperature_2m_max", "temperature_2m_min", "temperature_2m_mean", "precipitation_sum"],
+    "daily": DAILY_FEATURES,
     "timezone": "GMT"
-}
+})
+
+# persistent cache of geocoding results, opened on first use (see geo_cache)
+_geo_cache = None
+_geo_cache_lock = threading.Lock()
+
+
+@functools.cache
+def load_configs():
+    """
+    return: (dict) - the configuration settings in the config file
+    The config file is only read the first time this function is called, and not when the module is imported.
+    """
+    with open(CONFIG_FILE, "rb") as config_file:
+        return orjson.loads(config_file.read())
 
 
-def get_annual_data(daily_data_df):
+def get_annual_data(daily_data):
     """
-    param: daily_data_df (pd.DataFrame) - This Data Frame has daily values for weather.
-    return: (pd.Series) - This Series will contain the following annual weather data, indexed as follows:
+    param: daily_data (dict) - the "daily" values of a weather file, each one a list of daily values for weather.
+    return: (tuple) - This tuple will contain the following annual weather data, in the following order:
     --> min_temp, max_temp, avg_temp, total_annual_precipitation
     """
-    min_temp = round(daily_data_df["temperature_2m_min"].min(), 2)
-    max_temp = round(daily_data_df["temperature_2m_max"].max(), 2)
-    mean_temp = round(daily_data_df["temperature_2m_mean"].mean(), 2)
-    total_precipitation = round(daily_data_df["precipitation_sum"].sum(), 2)
-    return pd.Series((min_temp, max_temp, mean_temp, total_precipitation),
-                     index=("min_temp", "max_temp", "mean_temp", "total_precipitation"))
+    # convert the raw lists in one go, into one contiguous row per feature (missing days become NaN),
+    # and reduce them with numpy directly, without building a pandas DataFrame for every city.
+    # the values are stored as float32, but summed as float64, since a float32 running total over a year of
+    # precipitation can be off in the second decimal.
+    daily = np.array([daily_data[feature] for feature in DAILY_FEATURES], dtype=np.float32)
+    min_temp = round(float(np.nanmin(daily[0])), 2)
+    max_temp = round(float(np.nanmax(daily[1])), 2)
+    mean_temp = round(float(np.nanmean(daily[2], dtype=np.float64)), 2)
+    total_precipitation = round(float(np.nansum(daily[3], dtype=np.float64)), 2)
+    return min_temp, max_temp, mean_temp, total_precipitation
 
 
 def get_city_name(filename):
@@ -43,37 +75,61 @@ def get_city_name(filename):
         input: "buenos_aires_weather.json"
         returns: "buenos_aires
     """
-    pattern = r"([\w\s]+)_weather\.json"
-    return re.search(pattern, filename).group(1)
+    return filename.removesuffix(WEATHER_FILE_SUFFIX)
+
+
+def weather_file_entries(directory=WEATHER_FILES_DIR):
+    """
+    param: directory (str; default="weather_files") - the directory in which the weather files are saved
+    return: (list) - the os.DirEntry of every weather file in the directory
+    The directory is created if it does not exist yet.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # scandir already knows the type of each entry, so filtering doesn't need any extra stat calls
+    with os.scandir(directory) as entries:
+        return [entry for entry in entries if entry.is_file() and entry.name.endswith(WEATHER_FILE_SUFFIX)]
+
+
+def known_cities(directory=WEATHER_FILES_DIR):
+    """
+    param: directory (str; default="weather_files") - the directory in which the weather files are saved
+    return: (set) - the names of all the cities whose weather data is already saved in the directory.
+    The city names are formatted as in the filenames: all lowercase and with "_" instead of " "
+    """
+    return {get_city_name(entry.name) for entry in weather_file_entries(directory)}
 
 
-def weather_data_already_saved_for_city(city_name):
+def create_session(workers=WEATHER_API_WORKERS):
     """
-    param: city_name (str) - a name of a city
-    returns True or False, depending on whether there is a file in the
-    weather_files directory with the city_name in it.
-    The format for the city name should be all lowercase and with "_" instead of " "
-    if the city_name is formatted wrong, this function will correct that
+    param: workers (int) - the number of threads that will share the session
+    return: (requests.Session) - a session with a connection pool large enough for all workers.
+    Requests which fail with one of the RETRY_STATUS_CODES are retried (with backoff) by the adapter.
     """
-    # Check if the "weather_files" directory exists, and create it if it does not.
-    if not os.path.exists("weather_files"):
-        os.makedirs("weather_files")
+    retries = Retry(total=5, backoff_factor=0.3, status_forcelist=RETRY_STATUS_CODES)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    # correct format of city_name if it's wrong
-    city_name = city_name.lower().replace(" ", "_")
-    # Get a list of all the filenames in the "weather_files" directory.
-    filenames = os.listdir("weather_files")
-    for filename in filenames:
-        # Check if the city name is in the filename. If it is, return True to indicate that weather data has already
-        # been saved for this city.
-        if filename.find(city_name) != -1:
-            return True  # weather data already saved for this city
 
-    return False  # weather data has not been saved for this city
+def geo_cache():
+    """
+    return: (shelve.Shelf) - the persistent cache of geocoding results.
+        - maps "city|country" to (latitude, longitude)
+    The cache file is opened once, and closed when the interpreter exits.
+    Access to the cache should be guarded by _geo_cache_lock, since it is shared between threads.
+    """
+    global _geo_cache
+    if _geo_cache is None:
+        _geo_cache = shelve.open(GEO_CACHE_FILE)
+        atexit.register(_geo_cache.close)
+    return _geo_cache
 
 
-def lat_lon_of_city(city, country=None):
+def lat_lon_of_city(session, city, country=None):
     """
+    param: session (requests.Session) - the session used to make the request
     param: city (str) - a city name
     param: country (str) - a country name.
         - None by default. some cities appear in multiple countries,
@@ -81,27 +137,40 @@ def lat_lon_of_city(city, country=None):
     return (tuple) - a tuple in the following form: (latitude of city, longitude of city)
     The data for this function is requested from the following url:
     https://api-ninjas.com/api/geocoding
+    Results are cached on disk, so a city is only requested from the API once.
     """
+    key = f"{city}|{country or ''}"
+    with _geo_cache_lock:
+        cached = geo_cache().get(key)
+    if cached:
+        return cached
+
+    params = {"city": city}
     if country:
-        api_url = "https://api.api-ninjas.com/v1/geocoding?city={}&country={}{}".format(city, country, city)
-    else:
-        api_url = "https://api.api-ninjas.com/v1/geocoding?city={}".format(city)
-    while True:
-        response = requests.get(api_url, headers={"X-Api-Key": LAT_LON_API_KEY})
-        if response.status_code == requests.codes.ok:
-            break
-        elif response.status_code == RESOURCE_NOT_FOUND_RESPONSE_CODE:
-            return None, None
-        else:
-            continue  # try again
-    result = response.json()[0]
-    return result["latitude"], result["longitude"]
+        params["country"] = country
+    # failed requests are retried (a bounded number of times) by the session's adapter, so there is no need to loop
+    response = session.get(GEOCODING_API_URL, params=params, headers={"X-Api-Key": load_configs()["lat_lon_api_key"]})
+    if response.status_code == RESOURCE_NOT_FOUND_RESPONSE_CODE:
+        return None, None
+    response.raise_for_status()
+    results = response.json()
+    if not results:  # the API didn't find the city
+        return None, None
+    lat_lon = results[0]["latitude"], results[0]["longitude"]
+    with _geo_cache_lock:
+        cache = geo_cache()
+        cache[key] = lat_lon
+        cache.sync()
+    return lat_lon
 
 
-def request_from_weather_api(city, country=None):
+def request_from_weather_api(session, city, country=None, known=None):
     """
+    param: session (requests.Session) - the session used to make the requests
     param: city (str) - city name
     param: country (stt; default=None) - country name
+    param: known (set; default=None) - the cities whose weather data is already saved (see known_cities).
+        - the city is added to this set once its weather data is saved.
     This function is designed to connect to the weather API, https://open-meteo.com
     The function will take the parameters of city and country, and create the correct API URL.
     Then it will make a request from the API to get the following meteorological data.
@@ -111,27 +180,71 @@ def request_from_weather_api(city, country=None):
         [For 2022-04-01 to 2023-04-01]
         Max Temp, Min Temp, Mean Temp, Precipitation Sum (rain+snow)
     """
-    city = city.lower().replace(" ", "_")  # filename will be, for example, "buenos_aires_weather.json"
-    if weather_data_already_saved_for_city(city):
+    city_name = city.lower().replace(" ", "_")  # filename will be, for example, "buenos_aires_weather.json"
+    if known is None:
+        known = known_cities()
+    if city_name in known:
         return
     else:  # if we don't already have data for this city
+        # the geocoding API is given the city name as it is written, for example "Buenos Aires"
         if country:
-            latitude, longitude = lat_lon_of_city(city, country)
+            latitude, longitude = lat_lon_of_city(session, city, country)
         else:
-            latitude, longitude = lat_lon_of_city(city)
-
-        WEATHER_API_URL_PARAMS["latitude"] = latitude
-        WEATHER_API_URL_PARAMS["longitude"] = longitude
+            latitude, longitude = lat_lon_of_city(session, city)
+        if latitude is None or longitude is None:
+            print(f"Couldn't find the location of {city}, so its weather data won't be saved.")
+            return
 
-        url = WEATHER_API_BASE_URL + urllib.parse.urlencode(WEATHER_API_URL_PARAMS, doseq=True)
-        print(url)
-        response = requests.get(url)
+        params = {**WEATHER_API_URL_PARAMS_TEMPLATE, "latitude": latitude, "longitude": longitude}
+        response = session.get(WEATHER_API_BASE_URL, params=params)
+        print(response.url)
+        # don't save error responses, since the city would then be skipped (as known) on every later run
+        response.raise_for_status()
         data = response.json()
+        if "daily" not in data:
+            raise requests.RequestException(f"The weather API returned no daily data for {city}: {data}",
+                                            response=response)
+
+        filename = f"{city_name}{WEATHER_FILE_SUFFIX}"
+
+        with open(f"{WEATHER_FILES_DIR}/{filename}", "wb") as file:
+            file.write(orjson.dumps(data))  # write json to json file
+        known.add(city_name)
+
+
+def fetch_all_weather(cities, country_map=None, workers=WEATHER_API_WORKERS):
+    """
+    param: cities (list) - a list of city names
+    param: country_map (dict; default=None) - maps a city name to its country name
+    param: workers (int) - the number of threads used to make the requests
+    This function downloads the weather data of all the cities concurrently.
+    All the requests share one requests.Session, so connections are pooled and kept alive between requests.
+    Cities whose requests fail are logged and skipped, so one bad city doesn't lose the data of all the others.
+    """
+    country_map = country_map or dict()
+    known = known_cities()  # list the weather files directory once for all the cities
+    logger = logging.getLogger(load_configs()["logger_name"])
+
+    def fetch_city_weather(city):
+        try:
+            request_from_weather_api(session, city, country_map.get(city), known)
+        except requests.RequestException as e:
+            logger.error(f"Couldn't get the weather data of {city}, so it will be skipped: {e}")
+
+    with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume the results so that any other exception raised inside the threads is not lost
+        list(executor.map(fetch_city_weather, cities))
 
-        filename = f"{city}_weather.json"
 
-        with open(f"weather_files/{filename}", "w") as file:
-            json.dump(data, file)  # write json to json file
+def process_weather_file(path):
+    """
+    param: path (str) - the path of a weather json file, for example "weather_files/buenos_aires_weather.json"
+    return: (tuple) - (city name, min_temp, max_temp, mean_temp, total_precipitation), see get_annual_data
+    """
+    with open(path, "rb") as file:
+        data_dict = orjson.loads(file.read())
+    # Use the helper function "get_city_name()" to extract the city name from the filename.
+    return (get_city_name(os.path.basename(path)),) + get_annual_data(data_dict["daily"])
 
 
 def generate_weather_df():
@@ -143,25 +256,17 @@ def generate_weather_df():
     The weather features are all DAILY values for the year 2022-04-01 to 2023-04-01, but annual data will be
     calculated using a helper function. The final output will be a dataframe with the following columns:
         --> Min_temp, Max_temp, mean_temp, total_precipitation
+    When there are many weather files, they are processed in parallel (up to one process per CPU core).
     """
-    # Check if the "weather_files" directory exists, and create it if it does not.
-    if not os.path.exists("weather_files"):
-        os.makedirs("weather_files")
-
-    all_annual_data = dict()
-    # Get a list of all the filenames in the "weather_files" directory.
-    filenames = os.listdir("weather_files")
-    for filename in filenames:
-        with open(f"weather_files/{filename}", "r") as file:
-            json_str = file.read()
-        data_dict = json.loads(json_str)
-        # Create a Pandas DataFrame from the "daily" key of the "data_dict" dictionary.
-        daily_data_df = pd.DataFrame.from_dict(data_dict["daily"])
-        annual_data = get_annual_data(daily_data_df)
-        # Add the annual weather data for the city named in the filename to the "all_annual_data" dictionary.
-        # Use the helper function "get_city_name()" to extract the city name from the filename.
-        all_annual_data[get_city_name(filename)] = annual_data
-
-    met_data = pd.DataFrame.from_dict(all_annual_data, orient='index')
-    met_data = met_data.reset_index().rename(columns={'index': 'Name'})
-    return met_data
+    # Get the paths of all the weather files in the "weather_files" directory.
+    paths = [entry.path for entry in weather_file_entries()]
+    # one row of annual weather data per city
+    if len(paths) < MIN_FILES_FOR_PROCESS_POOL:
+        # starting the processes would take longer than processing a few files
+        rows = [process_weather_file(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+            rows = list(executor.map(process_weather_file, paths, chunksize=8))
+
+    # build the DataFrame once, directly from the rows
+    return pd.DataFrame(rows, columns=MET_DATA_COLUMNS)
@@ -1,31 +1,26 @@
 import pymysql
 import json
+import functools
 
-DATABASE = "Attractions"
-
-with open("mysql_config.json", "r") as mysql_config:
-    config = json.load(mysql_config)
-
-HOST = config["host"]
-USER = config["user"]
-PASSWORD = config["password"]
-DATABASE = config["database"]
+MYSQL_CONFIG_FILE = "mysql_config.json"
 
 # create dictionary to store the sql CREATE TABLE commands
 TABLES = dict()
 TABLES["cities"] = """
             CREATE TABLE IF NOT EXISTS cities (
                 id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255),
-                top_attractions_url VARCHAR(255)
+                name VARCHAR(255) NOT NULL,
+                top_attractions_url VARCHAR(255),
+                UNIQUE KEY uq_name (name)
             );"""
 
 TABLES["attractions"] = """
             CREATE TABLE IF NOT EXISTS attractions (
                 id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255),
+                name VARCHAR(255) NOT NULL,
                 city_id INT,
                 url VARCHAR(255),
+                UNIQUE KEY uq_name (name),
                 FOREIGN KEY (city_id) REFERENCES cities(id)
             );"""
 
@@ -39,13 +34,15 @@ TABLES["attraction_stats"] = """
                 average_review INT,
                 poor_review INT,
                 terrible_review INT,
+                UNIQUE KEY uq_attraction_id (attraction_id),
                 FOREIGN KEY (attraction_id) REFERENCES attractions(id)
             );"""
 
 TABLES["popular_mentions"] = """
             CREATE TABLE IF NOT EXISTS popular_mentions (
                 id INT AUTO_INCREMENT PRIMARY KEY,
-                popular_mention VARCHAR(255)
+                popular_mention VARCHAR(255) NOT NULL,
+                UNIQUE KEY uq_popular_mention (popular_mention)
             );"""
 
 TABLES["popular_mentions_attractions"] = """
@@ -53,6 +50,7 @@ TABLES["popular_mentions_attractions"] = """
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 attraction_id INT,
                 popular_mention_id INT,
+                UNIQUE KEY uq_attraction_popular_mention (attraction_id, popular_mention_id),
                 FOREIGN KEY (attraction_id) REFERENCES attractions(id),
                 FOREIGN KEY (popular_mention_id) REFERENCES popular_mentions(id)
             );"""
@@ -69,58 +67,119 @@ TABLES["meteorological_data"] = """
             );
 """
 
+# create dictionary to store the unique key of each table: (key name, key columns).
+# tables which were created before the keys were added to TABLES are migrated by add_unique_keys,
+# in the order of this dictionary (a table's duplicates are merged before the tables which reference it).
+UNIQUE_KEYS = dict()
+UNIQUE_KEYS["cities"] = ("uq_name", ("name",))
+UNIQUE_KEYS["attractions"] = ("uq_name", ("name",))
+UNIQUE_KEYS["popular_mentions"] = ("uq_popular_mention", ("popular_mention",))
+UNIQUE_KEYS["attraction_stats"] = ("uq_attraction_id", ("attraction_id",))
+UNIQUE_KEYS["popular_mentions_attractions"] = ("uq_attraction_popular_mention", ("attraction_id", "popular_mention_id"))
+
+# create dictionary to store the (table, column) pairs which reference the id of each table
+REFERENCES = dict()
+REFERENCES["cities"] = (("attractions", "city_id"), ("meteorological_data", "city_id"))
+REFERENCES["attractions"] = (("attraction_stats", "attraction_id"), ("popular_mentions_attractions", "attraction_id"))
+REFERENCES["popular_mentions"] = (("popular_mentions_attractions", "popular_mention_id"),)
+
+# create dictionary to store the (identifying column, id column) of each table whose ids may be looked up
+RECORD_ID_COLUMNS = dict()
+RECORD_ID_COLUMNS["cities"] = ("name", "id")
+RECORD_ID_COLUMNS["attractions"] = ("name", "id")
+RECORD_ID_COLUMNS["popular_mentions"] = ("popular_mention", "id")
+
+# the length of all the VARCHAR columns
+VARCHAR_LENGTH = 255
+
+STATS_COLUMNS = ("ranking", "num_reviewers", "excellent_review", "very_good_review",
+                 "average_review", "poor_review", "terrible_review")
+
 # create dictionary to store the sql INSERT INTO commands
+# every table has a unique key, so records which are already in the DB are skipped.
+# the tables which are referenced by other tables set LAST_INSERT_ID to the id of the record, whether it was
+# inserted now or already existed, so cursor.lastrowid is its id (see insert_record).
+# foreign keys are passed as ids, which also lets executemany send multi-row INSERTs for the other tables.
 INSERT_INTO = dict()
 INSERT_INTO["cities"] = (
     " INSERT INTO cities (name) "
-    " VALUES (%s);"
+    " VALUES (%s) "
+    " ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);"
 )
 
 INSERT_INTO["attractions"] = (
     " INSERT INTO attractions (name, city_id, url) "
-    " VALUES (%s, (SELECT id FROM cities WHERE cities.name=%s), %s);"
+    " VALUES (%s, %s, %s) "
+    " ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);"
 )
 
 INSERT_INTO["attraction_stats"] = (
-    " INSERT INTO attraction_stats "
+    " INSERT IGNORE INTO attraction_stats "
     "(attraction_id, ranking, num_reviewers, excellent_review, very_good_review, "
     " average_review, poor_review, terrible_review) "
-    "VALUES ((SELECT id FROM attractions WHERE attractions.name=%s), %s, %s, %s, %s, %s, %s, %s) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
 )
 
 INSERT_INTO["popular_mentions"] = (
     " INSERT INTO popular_mentions (popular_mention) "
     " VALUES (%s) "
+    " ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);"
 )
 
 INSERT_INTO["popular_mentions_attractions"] = (
-    " INSERT INTO popular_mentions_attractions (attraction_id, popular_mention_id) "
-    " VALUES ("
-    "   (SELECT id FROM attractions WHERE name=%s),"
-    "   (SELECT id FROM popular_mentions WHERE popular_mention=%s)"
-    ") "
+    " INSERT IGNORE INTO popular_mentions_attractions (attraction_id, popular_mention_id) "
+    " VALUES (%s, %s) "
 )
 
 INSERT_INTO["meteorological_data"] = (
-    " INSERT INTO meteorological_data (city_id, Name, min_temp, max_temp, mean_temp, total_precipitation) "
-    "VALUES ((SELECT id FROM cities WHERE cities.name = %s), %s, %s, %s, %s, %s)"
+    " INSERT IGNORE INTO meteorological_data (city_id, Name, min_temp, max_temp, mean_temp, total_precipitation) "
+    "VALUES (%s, %s, %s, %s, %s, %s)"
 )
 
 
-def already_recorded(data_table, var):
+@functools.cache
+def load_mysql_config():
     """
-    param: var (data_table) - a data_table name in DB
-    param: var (str) - a variable name
-    return: (boolean) - Return True if the variable is already in the chosen data_table of the Attractions database
+    return: (dict) - the connection details of the database (host, user, password, database)
+    The config file is only read the first time this function is called.
     """
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DATABASE) as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM {} WHERE name="{}";'.format(data_table, str(var)))
-        existing_records = c.fetchall()
-        if existing_records is None or len(existing_records) == 0:
-            return False
-        else:
-            return True
+    with open(MYSQL_CONFIG_FILE, "r") as mysql_config:
+        return json.load(mysql_config)
+
+
+def connect(use_database=True, **kwargs):
+    """
+    param: use_database (bool; default=True) - whether to connect to the project database, or only to the server
+    param: kwargs - any other keyword arguments for pymysql.connect
+    return: (pymysql.Connection) - a new connection, using the details in the mysql config file
+    """
+    config = load_mysql_config()
+    if use_database:
+        kwargs["database"] = config["database"]
+    return pymysql.connect(host=config["host"], user=config["user"], password=config["password"], **kwargs)
+
+
+def record_ids(cursor, data_table, col="name", values=None):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    param: data_table (str) - a data_table name in DB, which is in RECORD_ID_COLUMNS
+    param: col (str; default="name") - the column which identifies the records
+    param: values (iterable; default=None) - the values whose ids we want.
+        - None by default, in which case the ids of all the records are loaded
+    return: (dict) - maps each value (lowercase, since MySQL compares them case-insensitively) to the id of its record
+    """
+    # identifiers can't be passed as query parameters, so only accept the columns of the tables we created
+    if RECORD_ID_COLUMNS.get(data_table, (None,))[0] != col:
+        raise ValueError("Unknown column {} of table {}".format(col, data_table))
+    id_col = RECORD_ID_COLUMNS[data_table][1]
+    query = "SELECT `{}`, `{}` FROM `{}`".format(col, id_col, data_table)
+    if values is not None:
+        values = list(set(values))
+        if not values:
+            return dict()
+        query += " WHERE `{}` IN ({})".format(col, ", ".join(["%s"] * len(values)))
+    cursor.execute(query + ";", values)
+    return {value.lower(): record_id for value, record_id in cursor.fetchall()}
 
 
 def meteorological_data(met_df):
@@ -131,35 +190,44 @@ def meteorological_data(met_df):
     'Name', 'min_temp', 'max_temp', 'mean_temp', 'total_precipitation'
     return: no return
     """
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DATABASE) as conn:
+    # the whole load is a single transaction, committed once at the end
+    with connect(autocommit=False) as conn:
         c = conn.cursor()
-        for index, city in met_df.iterrows():
-            if already_recorded("meteorological_data", city["Name"]):
-                continue  # move to the next attraction
-
-            # only add the record if it isn't there already
-            else:
-                query = INSERT_INTO["meteorological_data"]
-                c.execute(query, (str(city["Name"]), str(city["Name"]), city["min_temp"],
-                                  city["max_temp"], city["mean_temp"],
-                                  city["total_precipitation"]))
-            conn.commit()
+        # the weather data names cities as in the weather filenames, for example "buenos_aires"
+        city_ids = {city.replace(" ", "_"): city_id for city, city_id in record_ids(c, "cities").items()}
+
+        met_rows = list()
+        columns = ["Name", "min_temp", "max_temp", "mean_temp", "total_precipitation"]
+        for name, min_temp, max_temp, mean_temp, total_precipitation in met_df[columns].itertuples(index=False,
+                                                                                                   name=None):
+            city_id = city_ids.get(str(name).lower())
+            if city_id is None:
+                continue  # no attractions were recorded for this city
+            met_rows.append((city_id, str(name), min_temp, max_temp, mean_temp, total_precipitation))
+
+        c.executemany(INSERT_INTO["meteorological_data"], met_rows)
+        conn.commit()
     return
 
 
-def popular_mention_already_recorded(popular_mention):
+def fit_varchar(value):
     """
-    param: popular_mention (str) a "popular_mention"
-    return: (boolean) - Return True if the popular_mention has already been recorded in the popular_mention table.
+    param: value (str) - a value for a VARCHAR column
+    return: (str) - the value, cut to the length of the VARCHAR columns
+    The value is cut here, rather than by MySQL, so the same (cut) value is sent with every insert.
     """
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DATABASE) as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM popular_mentions WHERE popular_mention="{}"'.format(popular_mention))
-        existing_records = c.fetchall()
-        if existing_records is None or len(existing_records) == 0:
-            return False
-        else:
-            return True
+    return value[:VARCHAR_LENGTH] if isinstance(value, str) else value
+
+
+def insert_record(cursor, data_table, values):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    param: data_table (str) - a data_table name in DB, whose INSERT_INTO command sets LAST_INSERT_ID
+    param: values (tuple) - the values of the record
+    return: (int) - the id of the record, whether it was inserted now or was already in the table
+    """
+    cursor.execute(INSERT_INTO[data_table], tuple(fit_varchar(value) for value in values))
+    return cursor.lastrowid
 
 
 def populate_tables(df):
@@ -171,44 +239,122 @@ def populate_tables(df):
            'Excellent_ratio', 'VG_ratio', 'Average_ratio', 'Poor_ratio', 'Terrible_ratio', 'Url'
     return: no return
     """
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DATABASE) as conn:
+    columns = ["City", "Name", "Url", "Tripadvisor rank", "Reviewers#", "Excellent", "Very good",
+               "Average", "Poor", "Terrible", "Popular Mentions"]
+
+    # the whole load is a single transaction, committed once at the end
+    with connect(autocommit=False) as conn:
         c = conn.cursor()
-        for index, attraction in df.iterrows():
-            if already_recorded("attractions", attraction["Name"]):
-                continue  # move to the next attraction
-
-            if not already_recorded("cities", attraction["City"]):
-                c.execute(INSERT_INTO["cities"], (attraction["City"],))
-
-            c.execute(INSERT_INTO["attractions"], (attraction["Name"], attraction["City"], attraction["Url"]))
-            c.execute(INSERT_INTO["attraction_stats"], (attraction["Name"], attraction["Tripadvisor rank"],
-                                                        attraction["Reviewers#"], attraction["Excellent"],
-                                                        attraction["Very good"], attraction["Average"],
-                                                        attraction["Poor"], attraction["Terrible"]))
-            conn.commit()
-
-            for popular_mention in attraction["Popular Mentions"]:  # only add the record if it isn't there already
-                if popular_mention_already_recorded(popular_mention):
-                    c.execute(INSERT_INTO["popular_mentions_attractions"], (attraction["Name"], popular_mention))
-                    conn.commit()
-                else:  # popular mention not yet recorded
-                    c.execute(INSERT_INTO["popular_mentions"], (popular_mention,))
-                    c.execute(INSERT_INTO["popular_mentions_attractions"], (attraction["Name"], popular_mention))
-                    conn.commit()
+        # the ids are read back from each insert, so they always belong to the record which MySQL matched,
+        # even when MySQL considers two different spellings equal (cases, accents).
+        city_ids, popular_mention_ids = dict(), dict()
+        stats_rows, pm_attr_rows = list(), list()
+        for (city, name, url, rank, reviewers, excellent, very_good,
+             average, poor, terrible, popular_mentions) in df[columns].itertuples(index=False, name=None):
+            if city not in city_ids:
+                city_ids[city] = insert_record(c, "cities", (city,))
+            attraction_id = insert_record(c, "attractions", (name, city_ids[city], url))
+            stats_rows.append((attraction_id, rank, reviewers, excellent, very_good, average, poor, terrible))
+
+            for popular_mention in popular_mentions:
+                if popular_mention not in popular_mention_ids:
+                    popular_mention_ids[popular_mention] = insert_record(c, "popular_mentions", (popular_mention,))
+                pm_attr_rows.append((attraction_id, popular_mention_ids[popular_mention]))
+
+        # the tables which aren't referenced by other tables are inserted in one batch each
+        c.executemany(INSERT_INTO["attraction_stats"], stats_rows)
+        c.executemany(INSERT_INTO["popular_mentions_attractions"], pm_attr_rows)
+        conn.commit()
     return
 
 
+def has_unique_key(cursor, data_table, key_name):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    param: data_table (str) - a data_table name in DB
+    param: key_name (str) - the name of a unique key
+    return: (boolean) - Return True if the data_table already has the key
+    """
+    cursor.execute("SELECT 1 FROM information_schema.statistics "
+                   "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1;",
+                   (data_table, key_name))
+    return cursor.fetchone() is not None
+
+
+def remove_duplicates(cursor, data_table, columns):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    param: data_table (str) - a data_table name in DB, which has an id column
+    param: columns (tuple) - the columns which should be unique
+    Only the record with the lowest id is kept out of each group of duplicates.
+    The records which referenced the removed duplicates are pointed to the kept record instead
+    (or removed, if the kept record is already referenced by an equal record).
+    """
+    group = ", ".join("`{}`".format(col) for col in columns)
+    # the extra SELECT makes MySQL materialize the groups, so they can be used while deleting from the same table
+    kept = "(SELECT * FROM (SELECT {}, MIN(id) AS keep_id FROM `{}` GROUP BY {}) AS grouped)".format(group, data_table,
+                                                                                                   group)
+    match = " AND ".join("duplicate.`{0}` = kept.`{0}`".format(col) for col in columns)
+    duplicates = "`{}` AS duplicate JOIN {} AS kept ON {}".format(data_table, kept, match)
+
+    for referencing_table, col in REFERENCES.get(data_table, ()):
+        references = ("`{}` AS reference JOIN `{}` AS duplicate ON reference.`{}` = duplicate.id "
+                      "JOIN {} AS kept ON {}").format(referencing_table, data_table, col, kept, match)
+        cursor.execute("UPDATE IGNORE {} SET reference.`{}` = kept.keep_id "
+                       "WHERE duplicate.id <> kept.keep_id;".format(references, col))
+        # the references which couldn't be moved, since they would have duplicated a reference to the kept record
+        cursor.execute("DELETE reference FROM {} WHERE duplicate.id <> kept.keep_id;".format(references))
+
+    cursor.execute("DELETE duplicate FROM {} WHERE duplicate.id <> kept.keep_id;".format(duplicates))
+
+
+def merge_duplicate_stats(cursor):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    The attraction_stats table has no id, so each attraction's duplicate stats are merged into a single record,
+    which holds the highest value of each stat (the stats only grow between scrapes).
+    """
+    stats = ", ".join("MAX(`{0}`) AS `{0}`".format(col) for col in STATS_COLUMNS)
+    cursor.execute("CREATE TEMPORARY TABLE merged_stats "
+                   "SELECT attraction_id, {} FROM attraction_stats WHERE attraction_id IS NOT NULL "
+                   "GROUP BY attraction_id HAVING COUNT(*) > 1;".format(stats))
+    cursor.execute("DELETE attraction_stats FROM attraction_stats JOIN merged_stats USING (attraction_id);")
+    columns = ", ".join(("attraction_id",) + STATS_COLUMNS)
+    cursor.execute("INSERT INTO attraction_stats ({0}) SELECT {0} FROM merged_stats;".format(columns))
+    cursor.execute("DROP TEMPORARY TABLE merged_stats;")
+
+
+def add_unique_keys(cursor):
+    """
+    param: cursor (pymysql.cursors.Cursor) - a cursor of an open connection to the Attractions database
+    The unique keys in TABLES only exist in tables which were created with them. Older databases hold the
+    duplicates which used to be inserted, so these are removed first, and then the missing keys are added.
+    """
+    for data_table, (key_name, columns) in UNIQUE_KEYS.items():
+        if has_unique_key(cursor, data_table, key_name):
+            continue
+        if data_table == "attraction_stats":
+            merge_duplicate_stats(cursor)
+        else:
+            remove_duplicates(cursor, data_table, columns)
+        cursor.execute("ALTER TABLE `{}` ADD UNIQUE KEY `{}` ({});".format(
+            data_table, key_name, ", ".join("`{}`".format(col) for col in columns)))
+
+
 def create_database():
     """
     This function is used to create the Attractions database, whose design can be found
     on the gitHub repo of this project: https://github.com/yoniabrams/webscraper_tripadvisor
     """
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD) as conn:
+    with connect(use_database=False) as conn:
         cursor = conn.cursor()
         cursor.execute("CREATE database IF NOT EXISTS ariel_yonatan;")
 
-    with pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DATABASE) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         # create all the tables (if each table doesn't exist already, respectively)
         for sql_table_creation_script in TABLES.values():
             cursor.execute(sql_table_creation_script)
+        # tables which already existed may not have their unique keys yet
+        add_unique_keys(cursor)
+        conn.commit()
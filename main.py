@@ -5,7 +5,7 @@ import pandas as pd
 from attraction_mining import attractions_data
 from handle_database import populate_tables, meteorological_data, create_database
 import argparse
-from api_access import generate_weather_df, request_from_weather_api
+from api_access import generate_weather_df, fetch_all_weather
 
 # Load configuration settings from a JSON file
 with open("config.json", "r") as config_file:
@@ -106,8 +106,7 @@ def storing_data(cities, attractions_num, cities_urls):
     attraction_df = attractions_data(urls, ranks, REQUEST_BATCH_SIZE)
 
     # Download meteorological data from api's
-    for city in cities:
-        request_from_weather_api(city)
+    fetch_all_weather(cities)
 
     # create a Pandas dataframe with the meteorological data
     met_df = generate_weather_df()